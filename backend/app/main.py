@@ -1,10 +1,20 @@
 # backend/app/main.py
 import os
-import shutil
 import uuid
+import hashlib
 import re 
 import logging
-from fastapi import FastAPI, File, UploadFile, HTTPException, Header
+import asyncio
+import multiprocessing
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote
+import aiofiles
+import aiofiles.os
+from fastapi import FastAPI, HTTPException, Header, Query, Request
+from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
@@ -13,8 +23,8 @@ from typing import List, Optional
 from crewai import Agent, Task, Crew, Process, LLM
 from app.tools.pdf_tool import PDFProcessingTool 
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# Set up logging (this module is the application entrypoint)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 # --- Pydantic Schemas ---
@@ -61,6 +71,9 @@ IMAGES_DIR_NAME = "images"
 MARKDOWN_DIR_NAME = "markdown_outputs"
 TEMP_UPLOADS_DIR_NAME = "temp_uploads"
 
+# Uploads are coalesced into writes of this size while streaming to disk.
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
 STATIC_PATH_ABS = os.path.join(APP_ROOT_DIR, STATIC_DIR_NAME)
 IMAGES_PATH_ABS = os.path.join(STATIC_PATH_ABS, IMAGES_DIR_NAME)
 MARKDOWN_PATH_ABS = os.path.join(STATIC_PATH_ABS, MARKDOWN_DIR_NAME)
@@ -70,29 +83,134 @@ TEMP_UPLOADS_PATH_ABS = os.path.join(BACKEND_ROOT_DIR, TEMP_UPLOADS_DIR_NAME)
 for directory in [STATIC_PATH_ABS, IMAGES_PATH_ABS, MARKDOWN_PATH_ABS, TEMP_UPLOADS_PATH_ABS]:
     try:
         os.makedirs(directory, exist_ok=True)
-        # Test write permissions
-        test_file = os.path.join(directory, "test.txt")
-        with open(test_file, "w") as f:
-            f.write("test")
-        os.remove(test_file)
-        logger.info(f"Successfully created and verified directory: {directory}")
+        # A single access(2) check; setup_static_dirs.py does a real write probe at deploy time
+        if not os.access(directory, os.W_OK):
+            raise PermissionError(f"Directory is not writable: {directory}")
+        logger.info("Successfully created and verified directory: %s", directory)
     except Exception as e:
-        logger.error(f"Failed to create or verify directory {directory}: {e}")
+        logger.error("Failed to create or verify directory %s: %s", directory, e)
         raise
 
 STATIC_URL_PATH = f"/{STATIC_DIR_NAME}"
 IMAGES_URL_PATH = f"{STATIC_URL_PATH}/{IMAGES_DIR_NAME}"
-MARKDOWN_URL_PATH = f"{STATIC_URL_PATH}/{MARKDOWN_DIR_NAME}"
+MARKDOWN_URL_PATH = "/download"
+
+# When running behind Nginx, set this to an `internal;` location aliased to MARKDOWN_PATH_ABS
+# (e.g. /internal/markdown) so downloads are handed off to Nginx with X-Accel-Redirect.
+MARKDOWN_X_ACCEL_PREFIX = os.environ.get("MARKDOWN_X_ACCEL_PREFIX", "").rstrip("/")
+
+# Precompiled once instead of being rebuilt on every request
+SAFE_NAME_RE = re.compile(r'[^\w_.-]')
+IMG_LINK_RE = re.compile(r"!\[.*?\]\((" + re.escape(IMAGES_URL_PATH) + r"/[^\)]+)\)")
+
+# --- Conversion Worker Pool ---
+# Caps how many conversions are in flight at once; requests beyond this wait for a slot
+# instead of piling OCR/render jobs and their temp files onto the pool's queue. Each
+# conversion also OCRs its pages on several threads, so by default a quarter of the CPUs
+# run conversions and the rest go to their page threads (see PDF_TOOL below).
+MAX_CONCURRENT_PDFS = int(os.environ.get("MAX_CONCURRENT_PDFS", max(1, (os.cpu_count() or 1) // 4)))
+CONVERT_SEM = asyncio.Semaphore(MAX_CONCURRENT_PDFS)
+
+# Conversions are CPU/IO heavy (OCR, rendering, LLM round trips) and run in separate
+# processes so the event loop stays free; more processes than concurrent conversions would
+# sit idle. Workers start on the first submit, when the server process already runs threads
+# (event loop, aiofiles), so they are not forked from it: forkserver/spawn workers start
+# clean and import this module (and the tool) themselves.
+MAX_PDF_WORKERS = int(os.environ.get("MAX_PDF_WORKERS", MAX_CONCURRENT_PDFS))
+_WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+EXECUTOR = ProcessPoolExecutor(
+    max_workers=MAX_PDF_WORKERS,
+    mp_context=multiprocessing.get_context(_WORKER_START_METHOD),
+)
 
-app.mount(STATIC_URL_PATH, StaticFiles(directory=STATIC_PATH_ABS), name="static")
-logger.info(f"Mounted static files from: {STATIC_PATH_ABS} at URL: {STATIC_URL_PATH}")
+@app.on_event("shutdown")
+def shutdown_executor():
+    EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    logger.info("Conversion worker pool shut down.")
 
+# Only images are served as static files; markdown goes through download_markdown below
+app.mount(IMAGES_URL_PATH, StaticFiles(directory=IMAGES_PATH_ABS), name="images")
+logger.info("Mounted static files from: %s at URL: %s", IMAGES_PATH_ABS, IMAGES_URL_PATH)
 
-# --- Helper Function for CrewAI Processing ---
-def process_pdf_with_crew(pdf_file_path: str, user_gemini_api_key: str) -> dict:
-    current_env_gemini_key = os.environ.get("GEMINI_API_KEY")
-    os.environ["GEMINI_API_KEY"] = user_gemini_api_key
 
+# --- PDF Tool ---
+# The tool's paths don't depend on the request, so one instance per process is shared.
+# Each of the MAX_CONCURRENT_PDFS conversions gets its share of the CPUs for its page
+# threads, and always at least two so OCR overlaps with rendering even on small machines.
+PDF_TOOL = PDFProcessingTool(
+    image_output_dir_param=IMAGES_PATH_ABS,
+    static_images_url_path_param=IMAGES_URL_PATH,
+    max_page_workers_param=max(2, (os.cpu_count() or 1) // MAX_CONCURRENT_PDFS)
+)
+
+# --- CrewAI Setup ---
+# Building the LLM, agents, tasks and crew is comparatively expensive, and only the API key
+# actually differs between requests (the PDF path is a kickoff input), so crews are cached
+# per key. The key is handed to the LLM directly; os.environ is never touched. Each worker
+# process runs one conversion at a time, so a cached crew is never kicked off concurrently.
+# CrewAI's tool cache is disabled: it is keyed on the tool input, which is the per-upload
+# temp path and never repeats, so on a long-lived crew it would only accumulate every
+# PDF's extracted text. Repeat uploads are served by the result cache in the endpoint.
+CREW_CACHE_SIZE = int(os.environ.get("CREW_CACHE_SIZE", "8"))
+# Verbose agents write every step to stdout; opt in with CREW_VERBOSE=1 when debugging
+CREW_VERBOSE = os.environ.get("CREW_VERBOSE", "0") == "1"
+
+@lru_cache(maxsize=CREW_CACHE_SIZE)
+def get_pdf_crew(gemini_api_key: str) -> Crew:
+    crew_llm = LLM(
+        model='gemini/gemini-1.5-flash-latest', 
+        api_key=gemini_api_key,
+        temperature=0
+    )
+    logger.info("CrewAI LLM initialized.")
+
+    pdf_analyzer = Agent(
+        role='PDF Content Analyst',
+        goal='Accurately extract all text content and images (as links) from the given PDF file. Utilize OCR for pages that are primarily scanned images. If the PDF processing tool returns an error message, output that error message directly.',
+        backstory="Expert in digital document processing. Extracts text directly, identifies and links images, and uses OCR for scanned pages to capture textual content. Critically, if the underlying PDF tool fails and returns an error string, this agent's primary goal becomes to report that exact error.",
+        tools=[PDF_TOOL],
+        llm=crew_llm, verbose=CREW_VERBOSE, allow_delegation=False, max_iter=7
+    )
+    structure_identifier = Agent(
+        role='Document Structure Semantic Analyzer',
+        goal='Identify the logical structure (headings, paragraphs, lists, tables, code blocks) of extracted PDF content. If the input content is an error message from a previous step, output that error message directly.',
+        backstory="AI with deep understanding of document layouts. It can infer structure from mixed content (text, OCR, image links) and preserve image links in their correct positions. If it receives an input that starts with 'Error:', it understands this is a propagated error and its task is to pass this error message on.",
+        llm=crew_llm, verbose=CREW_VERBOSE, allow_delegation=False, max_iter=10
+    )
+    markdown_converter = Agent(
+        role='Markdown Conversion Specialist',
+        goal='Convert structurally annotated content into clean, well-formatted Markdown. For images (including equations), the primary representation is the image link. If the input content is an error message from a previous step, output that error message directly.',
+        backstory="Meticulous AI excelling at generating perfect, standard-compliant Markdown. It ensures that text is well-formatted and pre-existing Markdown image links are correctly integrated. If it receives an input that starts with 'Error:', it understands this is a propagated error and its task is to pass this error message on.",
+        llm=crew_llm, verbose=CREW_VERBOSE, allow_delegation=False, max_iter=10
+    )
+    logger.info("CrewAI Agents defined.")
+
+    # --- Task Definitions (with updated expected_output for error propagation) ---
+    task_extract = Task(
+        description=f"Extract text content and images from the PDF located at '{{pdf_file_path}}'. The tool will attempt OCR for text on full scanned pages if direct text extraction yields little. Images should be saved and represented as Markdown links in the output (e.g., ![]({IMAGES_URL_PATH}/image.png)). Ensure all readable text (embedded or via full-page OCR) and all image references are captured.",
+        expected_output=f"A single string containing all extracted text from the PDF (including full-page OCR results where applicable) and Markdown links for any extracted images (e.g., ![]({IMAGES_URL_PATH}/image.png)). Page breaks should be noted. If the PDF processing tool encounters an unrecoverable error, output the exact error message string provided by the tool (it will likely start with 'Error:').",
+        agent=pdf_analyzer,
+    )
+    task_structure = Task(
+        description="Analyze the provided content (output of PDF extraction) and identify its logical structure. Determine headings, paragraphs, lists, tables, and code blocks. Preserve Markdown image links in their correct relative positions. If the input from the previous task is an error message (e.g., starts with 'Error:'), then your output should be that exact error message.",
+        expected_output="The original content, including Markdown image links, annotated or structured to clearly define elements (e.g., using XML-like tags or clear textual cues). If the input was an error message, output that exact error message.",
+        agent=structure_identifier, context=[task_extract]
+    )
+    task_convert = Task(
+        description=f"Take the structurally annotated content and convert it into well-formatted Markdown. Ensure existing Markdown image links (e.g., ![]({IMAGES_URL_PATH}/image.png)) are preserved. For visual elements like equations that are image links, ensure the link is present. Represent tables as Markdown tables. If the input from the previous task is an error message (e.g., starts with 'Error:'), then your output should be that exact error message.",
+        expected_output="A single string containing the final, clean Markdown representation of the document, including embedded images via Markdown links. If the input was an error message, output that exact error message.",
+        agent=markdown_converter, context=[task_structure]
+    )
+    logger.info("CrewAI Tasks defined. Creating crew.")
+
+    return Crew(
+        agents=[pdf_analyzer, structure_identifier, markdown_converter],
+        tasks=[task_extract, task_structure, task_convert],
+        process=Process.sequential, verbose=CREW_VERBOSE, memory=False, cache=False
+    )
+
+# --- Helper Function for CrewAI Processing ---
+def process_pdf_with_crew(pdf_file_path: str, user_gemini_api_key: str, persist_markdown: bool = False) -> dict:
     output_data = {
         "markdown_file_url": None, 
         "image_urls": [],          
@@ -101,64 +219,10 @@ def process_pdf_with_crew(pdf_file_path: str, user_gemini_api_key: str) -> dict:
     }
 
     try:
-        crew_llm = LLM(
-            model='gemini/gemini-1.5-flash-latest', 
-            api_key=os.environ["GEMINI_API_KEY"]
-        )
-        logger.info("CrewAI LLM initialized for request.")
-
-        pdf_tool_instance = PDFProcessingTool(
-            image_output_dir_param=IMAGES_PATH_ABS,       
-            static_images_url_path_param=IMAGES_URL_PATH  
-        )
+        pdf_crew = get_pdf_crew(user_gemini_api_key)
+        logger.info("CrewAI crew ready. Kicking off...")
 
-        pdf_analyzer = Agent(
-            role='PDF Content Analyst',
-            goal='Accurately extract all text content and images (as links) from the given PDF file. Utilize OCR for pages that are primarily scanned images. If the PDF processing tool returns an error message, output that error message directly.',
-            backstory="Expert in digital document processing. Extracts text directly, identifies and links images, and uses OCR for scanned pages to capture textual content. Critically, if the underlying PDF tool fails and returns an error string, this agent's primary goal becomes to report that exact error.",
-            tools=[pdf_tool_instance],
-            llm=crew_llm, verbose=True, allow_delegation=False, max_iter=7
-        )
-        structure_identifier = Agent(
-            role='Document Structure Semantic Analyzer',
-            goal='Identify the logical structure (headings, paragraphs, lists, tables, code blocks) of extracted PDF content. If the input content is an error message from a previous step, output that error message directly.',
-            backstory="AI with deep understanding of document layouts. It can infer structure from mixed content (text, OCR, image links) and preserve image links in their correct positions. If it receives an input that starts with 'Error:', it understands this is a propagated error and its task is to pass this error message on.",
-            llm=crew_llm, verbose=True, allow_delegation=False, max_iter=10
-        )
-        markdown_converter = Agent(
-            role='Markdown Conversion Specialist',
-            goal='Convert structurally annotated content into clean, well-formatted Markdown. For images (including equations), the primary representation is the image link. If the input content is an error message from a previous step, output that error message directly.',
-            backstory="Meticulous AI excelling at generating perfect, standard-compliant Markdown. It ensures that text is well-formatted and pre-existing Markdown image links are correctly integrated. If it receives an input that starts with 'Error:', it understands this is a propagated error and its task is to pass this error message on.",
-            llm=crew_llm, verbose=True, allow_delegation=False, max_iter=10
-        )
-        logger.info("CrewAI Agents defined for request.")
-
-        # --- Task Definitions (with updated expected_output for error propagation) ---
-        task_extract = Task(
-            description=f"Extract text content and images from the PDF located at '{pdf_file_path}'. The tool will attempt OCR for text on full scanned pages if direct text extraction yields little. Images should be saved and represented as Markdown links in the output (e.g., ![]({IMAGES_URL_PATH}/image.png)). Ensure all readable text (embedded or via full-page OCR) and all image references are captured.",
-            expected_output=f"A single string containing all extracted text from the PDF (including full-page OCR results where applicable) and Markdown links for any extracted images (e.g., ![]({IMAGES_URL_PATH}/image.png)). Page breaks should be noted. If the PDF processing tool encounters an unrecoverable error, output the exact error message string provided by the tool (it will likely start with 'Error:').",
-            agent=pdf_analyzer,
-        )
-        task_structure = Task(
-            description="Analyze the provided content (output of PDF extraction) and identify its logical structure. Determine headings, paragraphs, lists, tables, and code blocks. Preserve Markdown image links in their correct relative positions. If the input from the previous task is an error message (e.g., starts with 'Error:'), then your output should be that exact error message.",
-            expected_output="The original content, including Markdown image links, annotated or structured to clearly define elements (e.g., using XML-like tags or clear textual cues). If the input was an error message, output that exact error message.",
-            agent=structure_identifier, context=[task_extract]
-        )
-        task_convert = Task(
-            description=f"Take the structurally annotated content and convert it into well-formatted Markdown. Ensure existing Markdown image links (e.g., ![]({IMAGES_URL_PATH}/image.png)) are preserved. For visual elements like equations that are image links, ensure the link is present. Represent tables as Markdown tables. If the input from the previous task is an error message (e.g., starts with 'Error:'), then your output should be that exact error message.",
-            expected_output="A single string containing the final, clean Markdown representation of the document, including embedded images via Markdown links. If the input was an error message, output that exact error message.",
-            agent=markdown_converter, context=[task_structure]
-        )
-        logger.info("CrewAI Tasks defined for request.")
-
-        pdf_crew = Crew(
-            agents=[pdf_analyzer, structure_identifier, markdown_converter],
-            tasks=[task_extract, task_structure, task_convert],
-            process=Process.sequential, verbose=True, memory=False
-        )
-        logger.info("CrewAI crew created. Kicking off...")
-
-        crew_result_obj = pdf_crew.kickoff()
+        crew_result_obj = pdf_crew.kickoff(inputs={"pdf_file_path": pdf_file_path})
         
         final_markdown_content = ""
         # Prioritize getting the direct result string from the CrewOutput object
@@ -175,7 +239,7 @@ def process_pdf_with_crew(pdf_file_path: str, user_gemini_api_key: str) -> dict:
         # Check if the direct output (hopefully the specific error now) indicates a problem
         if final_markdown_content.strip().startswith("Error:") or "unable to process" in final_markdown_content.lower():
             output_data["error"] = final_markdown_content.strip() # Use the direct error message
-            logger.info(f"Propagated error from crew: {output_data['error']}") 
+            logger.info("Propagated error from crew: %s", output_data['error'])
             return output_data
         elif not final_markdown_content.strip():
             output_data["error"] = "Crew execution returned empty content."
@@ -184,79 +248,185 @@ def process_pdf_with_crew(pdf_file_path: str, user_gemini_api_key: str) -> dict:
         
         output_data["raw_markdown_content"] = final_markdown_content
 
-        pdf_basename = os.path.splitext(os.path.basename(pdf_file_path))[0]
-        safe_basename = re.sub(r'[^\w_.-]', '_', pdf_basename)
-        md_filename = f"{safe_basename}_{uuid.uuid4().hex[:8]}.md"
-        
-        markdown_file_abs_path = os.path.join(MARKDOWN_PATH_ABS, md_filename)
-
-        with open(markdown_file_abs_path, "w", encoding="utf-8") as f:
-            f.write(final_markdown_content)
-        
-        output_data["markdown_file_url"] = f"{MARKDOWN_URL_PATH}/{md_filename}"
-        logger.info(f"Markdown file saved to: {markdown_file_abs_path}")
-        logger.info(f"Markdown URL: {output_data['markdown_file_url']}")
-
-        img_pattern = r"!\[.*?\]\((" + re.escape(IMAGES_URL_PATH) + r"/[^\)]+)\)"
-        found_image_urls = re.findall(img_pattern, final_markdown_content)
-        output_data["image_urls"] = list(set(found_image_urls))
-        logger.info(f"Found image URLs in markdown: {output_data['image_urls']}")
+        # A dict keeps the image URLs de-duplicated in document order.
+        found_image_urls = {}
+        if persist_markdown:
+            pdf_basename = os.path.splitext(os.path.basename(pdf_file_path))[0]
+            safe_basename = SAFE_NAME_RE.sub('_', pdf_basename)
+            md_filename = f"{safe_basename}_{uuid.uuid4().hex[:8]}.md"
+            
+            markdown_file_abs_path = os.path.join(MARKDOWN_PATH_ABS, md_filename)
+
+            # Write the file and collect image URLs in the same scan over the content.
+            with open(markdown_file_abs_path, "w", encoding="utf-8") as f:
+                last_end = 0
+                for match in IMG_LINK_RE.finditer(final_markdown_content):
+                    f.write(final_markdown_content[last_end:match.end()])
+                    last_end = match.end()
+                    found_image_urls[match.group(1)] = None
+                f.write(final_markdown_content[last_end:])
+            
+            output_data["markdown_file_url"] = f"{MARKDOWN_URL_PATH}/{md_filename}"
+            logger.info("Markdown file saved to: %s", markdown_file_abs_path)
+            logger.info("Markdown URL: %s", output_data['markdown_file_url'])
+        else:
+            # The client reads raw_markdown_content, so there is nothing to write to disk
+            for match in IMG_LINK_RE.finditer(final_markdown_content):
+                found_image_urls[match.group(1)] = None
+
+        output_data["image_urls"] = list(found_image_urls)
+        logger.debug("Found image URLs in markdown: %s", output_data['image_urls'])
 
     except Exception as e:
         import traceback
         traceback.print_exc()
         output_data["error"] = f"Failed to process PDF with CrewAI: {str(e)}"
-    finally:
-        if current_env_gemini_key is not None:
-            os.environ["GEMINI_API_KEY"] = current_env_gemini_key
-        elif "GEMINI_API_KEY" in os.environ: 
-            del os.environ["GEMINI_API_KEY"]
-        logger.info("GEMINI_API_KEY environment variable handled for request scope.")
     return output_data
 
+# --- Temp File Cleanup ---
+async def remove_files(file_paths: List[str]):
+    """Removes files concurrently off the event loop. Files that are already gone are ignored."""
+    results = await asyncio.gather(*(aiofiles.os.remove(path) for path in file_paths), return_exceptions=True)
+    for file_path, result in zip(file_paths, results):
+        if result is None:
+            logger.debug("Cleaned up temporary file: %s", file_path)
+        elif not isinstance(result, FileNotFoundError):
+            logger.error("Error cleaning up file %s: %s", file_path, result)
+
+# --- Generated File Expiry ---
+# Images are linked from the response and fetched by the client afterwards, so they can't be
+# deleted with the request; a periodic sweep removes those older than IMAGE_TTL_SECONDS.
+# Persisted markdown files link to those images, so they expire on the same clock and a
+# download never outlives its images.
+IMAGE_TTL_SECONDS = int(os.environ.get("IMAGE_TTL_SECONDS", "3600"))
+if IMAGE_TTL_SECONDS <= 0:
+    raise ValueError(f"IMAGE_TTL_SECONDS must be a positive number of seconds, got {IMAGE_TTL_SECONDS}")
+IMAGE_SWEEP_INTERVAL_SECONDS = max(1, min(300, IMAGE_TTL_SECONDS))
+_file_sweep_task: Optional[asyncio.Task] = None
+
+def find_expired_files(directory: str, max_age_seconds: int) -> List[str]:
+    """Returns the paths of files in directory last modified more than max_age_seconds ago."""
+    cutoff = time.time() - max_age_seconds
+    expired = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    expired.append(entry.path)
+            except FileNotFoundError:
+                pass
+    return expired
+
+async def sweep_expired_files():
+    while True:
+        try:
+            for directory in (IMAGES_PATH_ABS, MARKDOWN_PATH_ABS):
+                expired = await asyncio.to_thread(find_expired_files, directory, IMAGE_TTL_SECONDS)
+                if expired:
+                    await remove_files(expired)
+                    logger.info("Removed %d expired file(s) from %s.", len(expired), directory)
+        except Exception as e:
+            logger.error("Error sweeping expired files: %s", e)
+        await asyncio.sleep(IMAGE_SWEEP_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_file_sweep():
+    global _file_sweep_task
+    _file_sweep_task = asyncio.create_task(sweep_expired_files())
+
+@app.on_event("shutdown")
+def stop_file_sweep():
+    if _file_sweep_task is not None:
+        _file_sweep_task.cancel()
+
+# --- Conversion Result Cache ---
+# Successful results are kept in the server process, keyed on the SHA-256 of the uploaded
+# PDF, a hash of the API key and the persist flag, so re-uploading a PDF skips the crew (and
+# its Gemini calls) entirely. A hit resets the expiry clock of the entry's images (and
+# persisted markdown file); an entry whose files have already been swept is dropped.
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "32"))
+_result_cache: OrderedDict = OrderedDict()
+
+def touch_result_files(result: dict) -> bool:
+    """Marks a result's images and persisted markdown file as just used. Returns False if any of them is gone."""
+    try:
+        for img_url in result["image_urls"]:
+            os.utime(os.path.join(IMAGES_PATH_ABS, os.path.basename(img_url)))
+        if result.get("markdown_file_url"):
+            os.utime(os.path.join(MARKDOWN_PATH_ABS, os.path.basename(result["markdown_file_url"])))
+    except FileNotFoundError:
+        return False
+    return True
+
+async def get_cached_result(cache_key: tuple) -> Optional[dict]:
+    result = _result_cache.get(cache_key)
+    if result is None:
+        return None
+    if not await asyncio.to_thread(touch_result_files, result):
+        _result_cache.pop(cache_key, None)
+        return None
+    if cache_key in _result_cache:
+        _result_cache.move_to_end(cache_key)
+    return result
+
+def store_cached_result(cache_key: tuple, result: dict):
+    _result_cache[cache_key] = result
+    _result_cache.move_to_end(cache_key)
+    while len(_result_cache) > RESULT_CACHE_MAX_ENTRIES:
+        _result_cache.popitem(last=False)
+
 # --- API Endpoint ---
 @app.post("/api/v1/convert", response_model=ConversionResponse)
 async def convert_pdf_endpoint(
+    request: Request,
     gemini_api_key: str = Header(..., description="User's Gemini API Key"),
-    pdf_file: UploadFile = File(..., description="PDF file to be converted.")
+    pdf_filename: str = Header(..., description="URL-encoded name of the uploaded PDF. The request body is the raw PDF bytes."),
+    persist: bool = Query(False, description="Keep the generated Markdown file on the server and return its download URL.")
 ):
-    if not pdf_file.filename.lower().endswith(".pdf"):
+    original_filename = unquote(pdf_filename)
+    if not original_filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Invalid file type. Only PDF files are accepted.")
 
     if not gemini_api_key or not gemini_api_key.strip():
         raise HTTPException(status_code=400, detail="Gemini API key is required.")
 
-    original_filename = pdf_file.filename
-    safe_filename_base = re.sub(r'[^\w_.-]', '_', os.path.splitext(original_filename)[0])
+    safe_filename_base = SAFE_NAME_RE.sub('_', os.path.splitext(os.path.basename(original_filename))[0])
     temp_pdf_filename = f"{uuid.uuid4().hex}_{safe_filename_base}.pdf"
     temp_pdf_path = os.path.join(TEMP_UPLOADS_PATH_ABS, temp_pdf_filename)
     
-    generated_files_to_clean = [] 
-
     try:
-        with open(temp_pdf_path, "wb") as buffer:
-            shutil.copyfileobj(pdf_file.file, buffer)
-        logger.info(f"Temporarily saved uploaded PDF to: {temp_pdf_path}")
-        generated_files_to_clean.append(temp_pdf_path)
-
-        result = process_pdf_with_crew(pdf_file_path=temp_pdf_path, user_gemini_api_key=gemini_api_key)
-
-        if result.get("error"):
-            logger.info(f"Error from process_pdf_with_crew to be sent to client: {result.get('error')}")
-            raise HTTPException(status_code=500, detail=result.get("error"))
-
-        # Add generated markdown and image files to cleanup list
-        if result.get("markdown_file_url"):
-            md_filename = os.path.basename(result["markdown_file_url"])
-            md_abs_path = os.path.join(MARKDOWN_PATH_ABS, md_filename)
-            generated_files_to_clean.append(md_abs_path)
-        
-        if result.get("image_urls"):
-            for img_url in result["image_urls"]:
-                img_filename = os.path.basename(img_url)
-                img_abs_path = os.path.join(IMAGES_PATH_ABS, img_filename)
-                generated_files_to_clean.append(img_abs_path)
-
+        # Stream the request body straight to disk instead of letting FastAPI spool it first,
+        # hashing it on the way for the result cache.
+        pdf_digest = hashlib.sha256()
+        async with aiofiles.open(temp_pdf_path, "wb") as buffer:
+            pending = bytearray()
+            async for chunk in request.stream():
+                pdf_digest.update(chunk)
+                pending += chunk
+                if len(pending) >= UPLOAD_CHUNK_SIZE:
+                    await buffer.write(pending)
+                    pending.clear()
+            if pending:
+                await buffer.write(pending)
+        logger.info("Temporarily saved uploaded PDF to: %s", temp_pdf_path)
+
+        cache_key = (pdf_digest.hexdigest(), hashlib.sha256(gemini_api_key.encode()).hexdigest(), persist)
+        result = await get_cached_result(cache_key)
+        if result is not None:
+            logger.info("Using cached conversion result for: %s", original_filename)
+        else:
+            async with CONVERT_SEM:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    EXECUTOR, process_pdf_with_crew, temp_pdf_path, gemini_api_key, persist
+                )
+
+            if result.get("error"):
+                logger.info("Error from process_pdf_with_crew to be sent to client: %s", result.get('error'))
+                raise HTTPException(status_code=500, detail=result.get("error"))
+            store_cached_result(cache_key, result)
+
+        # Extracted images are left for the client to fetch, and a persisted markdown file for
+        # markdown_file_url; both expire via sweep_expired_files.
         return ConversionResponse(
             message="PDF processed successfully.",
             markdown_file_url=result.get("markdown_file_url"),
@@ -270,14 +440,25 @@ async def convert_pdf_endpoint(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
     finally:
-        # Clean up temporary files
-        for file_path in generated_files_to_clean:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.info(f"Cleaned up temporary file: {file_path}")
-            except Exception as e_clean:
-                logger.error(f"Error cleaning up file {file_path}: {e_clean}")
+        # The uploaded PDF is only needed by the conversion itself
+        await remove_files([temp_pdf_path])
+
+
+@app.get(f"{MARKDOWN_URL_PATH}/{{md_filename}}", tags=["Downloads"])
+async def download_markdown(md_filename: str):
+    # Only bare file names from MARKDOWN_PATH_ABS are served
+    if os.path.basename(md_filename) != md_filename or not md_filename.endswith(".md"):
+        raise HTTPException(status_code=404, detail="Markdown file not found.")
+    md_abs_path = os.path.join(MARKDOWN_PATH_ABS, md_filename)
+    if not os.path.isfile(md_abs_path):
+        raise HTTPException(status_code=404, detail="Markdown file not found.")
+
+    headers = {"Content-Disposition": f'attachment; filename="{md_filename}"'}
+    if MARKDOWN_X_ACCEL_PREFIX:
+        # Nginx streams the file itself with sendfile(2); Python never touches the bytes
+        headers["X-Accel-Redirect"] = f"{MARKDOWN_X_ACCEL_PREFIX}/{md_filename}"
+        return Response(headers=headers, media_type="text/markdown")
+    return FileResponse(md_abs_path, media_type="text/markdown", headers=headers)
 
 
 @app.get("/", tags=["Root"])
@@ -4,14 +4,17 @@ import stat
 def setup_static_directories():
     # Get the absolute path to the app directory
     app_dir = os.path.dirname(os.path.abspath(__file__))
+    backend_dir = os.path.dirname(app_dir)
     
     # Define paths
     static_dir = os.path.join(app_dir, "static")
     images_dir = os.path.join(static_dir, "images")
     markdown_dir = os.path.join(static_dir, "markdown_outputs")
+    temp_uploads_dir = os.path.join(backend_dir, "temp_uploads")
+    directories = [static_dir, images_dir, markdown_dir, temp_uploads_dir]
     
     # Create directories if they don't exist
-    for directory in [static_dir, images_dir, markdown_dir]:
+    for directory in directories:
         if not os.path.exists(directory):
             os.makedirs(directory)
             print(f"Created directory: {directory}")
@@ -20,17 +23,23 @@ def setup_static_directories():
         os.chmod(directory, stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH)
         print(f"Set permissions for: {directory}")
     
-    # Verify directories exist and are writable
-    for directory in [static_dir, images_dir, markdown_dir]:
+    # Verify directories exist and are writable. This is the only place that actually
+    # writes a probe file; the app itself just checks os.access at startup.
+    for directory in directories:
         if not os.path.exists(directory):
             print(f"Error: Directory does not exist: {directory}")
             continue
             
-        if not os.access(directory, os.W_OK):
-            print(f"Error: Directory is not writable: {directory}")
+        test_file = os.path.join(directory, "test.txt")
+        try:
+            with open(test_file, "w") as f:
+                f.write("test")
+            os.remove(test_file)
+        except OSError as e:
+            print(f"Error: Directory is not writable: {directory} ({e})")
             continue
             
         print(f"Verified directory: {directory} (exists and writable)")
 
 if __name__ == "__main__":
-    setup_static_directories() 
\ No newline at end of file
+    setup_static_directories() 
@@ -1,19 +1,63 @@
 # backend/app/tools/pdf_tool.py
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from crewai.tools import BaseTool
-from typing import ClassVar, List
+from typing import ClassVar, List, Optional, Tuple
 import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
 import fitz  # PyMuPDF
 from PIL import Image
-import pytesseract
-from pdf2image import convert_from_path, pdfinfo_from_path
+from tesserocr import PyTessBaseAPI
 import logging
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# Logging is configured by the application entrypoint (app/main.py)
 logger = logging.getLogger(__name__)
 
+# Neither PDFium nor MuPDF may be called from several threads at once (not even on
+# different documents), so calls into them are serialized. Tesseract releases the
+# GIL while recognizing, so OCR overlaps freely across pages.
+_PDFIUM_LOCK = threading.Lock()
+_PYMUPDF_LOCK = threading.Lock()
+
+_SAFE_NAME_RE = re.compile(r'[^\w_.-]')
+
+# The text extraction method depends only on the installed pypdfium2 version, so it is
+# resolved once here rather than with try/except AttributeError on every page.
+_get_page_text = (
+    getattr(pdfium.PdfTextPage, "get_text_bounded", None)
+    or getattr(pdfium.PdfTextPage, "get_text_range", None)
+    or str
+)
+
+class _TesseractEngines:
+    """
+    Hands each worker thread its own PyTessBaseAPI (the API is not thread-safe), so the
+    language model is loaded once per thread instead of once per page.
+    """
+    def __init__(self, lang: str):
+        self._lang = lang
+        self._local = threading.local()
+        self._apis = []
+        self._apis_lock = threading.Lock()
+
+    def image_to_string(self, image: Image.Image) -> str:
+        api = getattr(self._local, "api", None)
+        if api is None:
+            api = PyTessBaseAPI(lang=self._lang)
+            self._local.api = api
+            with self._apis_lock:
+                self._apis.append(api)
+        api.SetImage(image)
+        return api.GetUTF8Text()
+
+    def close(self):
+        with self._apis_lock:
+            for api in self._apis:
+                api.End()
+            self._apis.clear()
+
 class PDFProcessingTool(BaseTool):
     name: str = "PDF Content and Image Extractor"
     description: str = (
@@ -24,93 +68,95 @@ class PDFProcessingTool(BaseTool):
     )
     # Define a threshold for considering a page as potentially image-based
     MIN_TEXT_LENGTH_FOR_NO_OCR: ClassVar[int] = 50 # If text length is less than this, consider OCR
+    OCR_DPI: ClassVar[int] = 300 # Resolution pages are rendered at for OCR
+    OCR_FALLBACK_DPI: ClassVar[int] = 200 # Used instead when OCR_DPI would exceed MAX_OCR_PIXELS
+    MAX_OCR_PIXELS: ClassVar[int] = 36_000_000 # Roughly an A2 page at 300 DPI (A3 is ~17.4 MP)
+    MIN_IMAGE_COVERAGE_FOR_OCR: ClassVar[float] = 0.1 # Fraction of the page images must cover to be worth OCR
+    # Embedded image formats written through as-is; anything else (JPX, JBIG2, TIFF, ...)
+    # is converted to PNG because Markdown viewers and browsers can't display it.
+    WEB_IMAGE_EXTENSIONS: ClassVar[frozenset] = frozenset({"png", "jpg", "jpeg", "webp"})
+    OCR_LANG: ClassVar[str] = "eng"
 
     # These will be instance attributes, not Pydantic fields of the BaseTool model itself.
     _image_output_dir_absolute: str
     _static_images_url_path: str
+    _max_page_workers: int
 
-    def __init__(self, image_output_dir_param: str, static_images_url_path_param: str, **kwargs):
+    def __init__(self, image_output_dir_param: str, static_images_url_path_param: str,
+                 max_page_workers_param: Optional[int] = None, **kwargs):
         """
         Initializes the tool with paths for image handling.
         Args:
             image_output_dir_param: Absolute path to save extracted images.
             static_images_url_path_param: Base URL path for serving these images (e.g., /static/images).
+            max_page_workers_param: Threads used to process the pages of one PDF. Defaults to the
+                CPU count; lower it when several conversions run side by side in separate processes.
         """
         super().__init__(**kwargs)
         self._image_output_dir_absolute = image_output_dir_param
         self._static_images_url_path = static_images_url_path_param
+        self._max_page_workers = max(1, max_page_workers_param or os.cpu_count() or 1)
         
         # Ensure the image directory exists and is writable
         try:
             os.makedirs(self._image_output_dir_absolute, exist_ok=True)
-            # Test write permissions
-            test_file = os.path.join(self._image_output_dir_absolute, "test.txt")
-            with open(test_file, "w") as f:
-                f.write("test")
-            os.remove(test_file)
-            logger.info(f"Successfully verified write permissions for: {self._image_output_dir_absolute}")
+            if not os.access(self._image_output_dir_absolute, os.W_OK):
+                raise PermissionError(f"Image directory is not writable: {self._image_output_dir_absolute}")
+            logger.info("Successfully verified write permissions for: %s", self._image_output_dir_absolute)
         except Exception as e:
-            logger.error(f"Failed to create or verify image directory: {e}")
+            logger.error("Failed to create or verify image directory: %s", e)
             raise
         
-        logger.info(f"PDFProcessingTool initialized with:")
-        logger.info(f"Image output directory: {self._image_output_dir_absolute}")
-        logger.info(f"Static images URL path: {self._static_images_url_path}")
+        logger.info("PDFProcessingTool initialized with:")
+        logger.info("Image output directory: %s", self._image_output_dir_absolute)
+        logger.info("Static images URL path: %s", self._static_images_url_path)
 
-    def _extract_images_with_pymupdf(self, pdf_file_path: str, page_index: int, pdf_filename_base: str) -> List[str]:
+    def _extract_images_with_pymupdf(self, fitz_doc: fitz.Document, page_index: int, pdf_filename_base: str) -> List[str]:
         """
         Extract images from a PDF page using PyMuPDF.
+        The document is opened once per run by the caller and shared across pages.
         Returns a list of markdown image links.
         """
         markdown_image_links = []
         try:
-            pdf_file = fitz.open(pdf_file_path)
-            page = pdf_file.load_page(page_index)
+            page = fitz_doc.load_page(page_index)
             image_list = page.get_images(full=True)
 
             if image_list:
-                logger.info(f"Found {len(image_list)} images on page {page_index + 1}")
+                logger.debug("Found %d images on page %d", len(image_list), page_index + 1)
                 
                 for image_index, img in enumerate(image_list, start=1):
                     try:
                         xref = img[0]
-                        base_image = pdf_file.extract_image(xref)
+                        base_image = fitz_doc.extract_image(xref)
                         image_bytes = base_image["image"]
                         image_ext = base_image["ext"]
+                        if image_ext not in self.WEB_IMAGE_EXTENSIONS:
+                            image_bytes = self._pixmap_to_png(fitz_doc, xref)
+                            image_ext = "png"
 
                         # Save the image
                         image_filename = f"{pdf_filename_base}_page{page_index+1}_img{image_index}.{image_ext}"
                         image_save_path = os.path.join(self._image_output_dir_absolute, image_filename)
                         
-                        logger.debug(f"Attempting to save image to: {image_save_path}")
-                        
-                        # Ensure the directory exists
-                        os.makedirs(os.path.dirname(image_save_path), exist_ok=True)
-                        
-                        # Save the image
+                        # The directory is created in __init__; a failed write raises and is
+                        # reported below, so no extra existence or size checks are needed.
                         with open(image_save_path, "wb") as image_file:
                             image_file.write(image_bytes)
-                        
-                        # Verify the file was saved
-                        if os.path.exists(image_save_path):
-                            file_size = os.path.getsize(image_save_path)
-                            logger.info(f"Successfully saved image: {image_filename} (size: {file_size} bytes)")
-                        else:
-                            logger.error(f"Failed to save image: {image_filename}")
-                            continue
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("Saved image: %s (size=%d bytes)", image_save_path, len(image_bytes))
 
                         # Create markdown link
                         image_url = f"{self._static_images_url_path}/{image_filename}"
                         markdown_link = f"\n\n![Page {page_index+1} Image {image_index}]({image_url})\n"
                         markdown_image_links.append(markdown_link)
-                        logger.debug(f"Created markdown link: {markdown_link}")
+                        logger.debug("Created markdown link: %s", markdown_link)
 
                     except Exception as e_img:
                         error_msg = f"Error processing image {image_index} on page {page_index + 1}: {e_img}"
                         logger.error(error_msg)
                         markdown_image_links.append(f"\n[Error processing image {image_index} on page {page_index + 1}: {e_img}]\n")
 
-            pdf_file.close()
             return markdown_image_links
 
         except Exception as e:
@@ -118,6 +164,124 @@ class PDFProcessingTool(BaseTool):
             logger.error(error_msg)
             return [f"\n[Error in image extraction for page {page_index + 1}: {e}]\n"]
 
+    def _image_coverage(self, page: pdfium.PdfPage) -> float:
+        """
+        Returns the fraction (0.0-1.0) of the page area covered by image objects.
+        Must be called with _PDFIUM_LOCK held.
+        """
+        page_width, page_height = page.get_size()
+        page_area = page_width * page_height
+        if page_area <= 0:
+            return 0.0
+
+        image_area = 0.0
+        for image_obj in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,)):
+            left, bottom, right, top = image_obj.get_pos()
+            image_area += max(0.0, right - left) * max(0.0, top - bottom)
+        return min(image_area / page_area, 1.0)
+
+    def _ocr_render_scale(self, page: pdfium.PdfPage) -> float:
+        """
+        Returns the pdfium render scale for OCR, dropping to OCR_FALLBACK_DPI for pages
+        that would exceed MAX_OCR_PIXELS at OCR_DPI. Must be called with _PDFIUM_LOCK held.
+        """
+        page_width, page_height = page.get_size()  # in points (1/72 inch)
+        dpi = self.OCR_DPI
+        if (page_width * dpi / 72) * (page_height * dpi / 72) > self.MAX_OCR_PIXELS:
+            dpi = self.OCR_FALLBACK_DPI
+        return dpi / 72
+
+    @staticmethod
+    def _pixmap_to_png(fitz_doc: fitz.Document, xref: int) -> bytes:
+        """
+        Decodes an embedded image with MuPDF and re-encodes it as PNG (libpng inside
+        MuPDF, no round trip through PIL). Must be called with _PYMUPDF_LOCK held.
+        """
+        pix = fitz.Pixmap(fitz_doc, xref)
+        if pix.n - pix.alpha > 3:  # PNG has no CMYK/DeviceN, convert to RGB first
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        return pix.tobytes("png")
+
+    def _process_page(self, pdf: pdfium.PdfDocument, fitz_doc: fitz.Document, ocr_engines: _TesseractEngines, i: int,
+                      pdf_filename_base: str, force_ocr_all_pages: bool, force_ocr_pages: List[int]) -> Tuple[int, List[str]]:
+        """
+        Extracts the text (with OCR if needed) and images of a single page.
+        Safe to run concurrently for different pages of the same document.
+        Returns:
+            The page index and the list of content parts for that page.
+        """
+        page_content_parts = []
+        page_text_content = ""
+        perform_ocr_on_this_page = False
+
+        # PDFium objects are closed explicitly while the lock is held; left to their
+        # finalizers they would be freed later, on this thread, without the lock.
+        with _PDFIUM_LOCK:
+            page = pdf.get_page(i)
+        try:
+            with _PDFIUM_LOCK:
+                # 1. Try direct text extraction
+                textpage = page.get_textpage()
+                try:
+                    page_text_content = _get_page_text(textpage).strip()
+                finally:
+                    textpage.close()
+
+                # 2. Decide if OCR is needed for this page
+                if force_ocr_all_pages:
+                    perform_ocr_on_this_page = True
+                    logger.debug("Forcing OCR on page %d as per force_ocr_all_pages flag.", i+1)
+                elif force_ocr_pages and i in force_ocr_pages:
+                    perform_ocr_on_this_page = True
+                    logger.debug("Forcing OCR on page %d as per force_ocr_pages list.", i+1)
+                elif len(page_text_content) < self.MIN_TEXT_LENGTH_FOR_NO_OCR:
+                    # Only scanned content is worth rasterizing; blank pages, vector diagrams and
+                    # pages with just small images (logos, icons) would yield nothing useful.
+                    image_coverage = self._image_coverage(page)
+                    if image_coverage >= self.MIN_IMAGE_COVERAGE_FOR_OCR:
+                        logger.debug("Page %d has minimal direct text (length: %d) and images cover %.0f%% of it. Attempting OCR.", i+1, len(page_text_content), image_coverage * 100)
+                        perform_ocr_on_this_page = True
+                    else:
+                        logger.debug("Page %d has minimal direct text and no significant images. Skipping OCR.", i+1)
+
+            # 3. Perform OCR if decided
+            if perform_ocr_on_this_page:
+                try:
+                    logger.debug("Attempting OCR on page %d...", i+1)
+                    # Render the already-loaded page in-process, straight to grayscale
+                    with _PDFIUM_LOCK:
+                        bitmap = page.render(scale=self._ocr_render_scale(page), rotation=0, grayscale=True)
+                        try:
+                            pil_image = bitmap.to_pil().copy()  # to_pil() shares the bitmap's buffer
+                        finally:
+                            bitmap.close()
+                    ocr_text = ocr_engines.image_to_string(pil_image).strip()
+                    if ocr_text:
+                        logger.debug("OCR successful for page %d. Length: %d", i+1, len(ocr_text))
+                        if len(page_text_content) < self.MIN_TEXT_LENGTH_FOR_NO_OCR:
+                            page_text_content = ocr_text
+                        else:
+                            page_text_content += "\n\n--- OCR Text ---\n" + ocr_text
+                    else:
+                        logger.debug("OCR for page %d yielded no text.", i+1)
+                except Exception as e:
+                    ocr_error_msg = f"\n[OCR error on page {i+1}: {str(e)}]"
+                    page_text_content += ocr_error_msg
+                    logger.error(ocr_error_msg.strip())
+        finally:
+            with _PDFIUM_LOCK:
+                page.close()
+
+        if page_text_content:
+            page_content_parts.append(page_text_content)
+
+        # 4. Extract images using PyMuPDF
+        with _PYMUPDF_LOCK:
+            image_links = self._extract_images_with_pymupdf(fitz_doc, i, pdf_filename_base)
+        page_content_parts.extend(image_links)
+
+        return i, page_content_parts
+
     def _run(self, pdf_file_path: str, force_ocr_all_pages: bool = False, force_ocr_pages: List[int] = None) -> str:
         """
         Extracts text and images from a PDF, attempting OCR on image-like pages.
@@ -136,95 +300,39 @@ class PDFProcessingTool(BaseTool):
         if force_ocr_pages is None:
             force_ocr_pages = []
 
-        pdf_filename_base = os.path.splitext(os.path.basename(pdf_file_path))[0]
-        pdf_filename_base = re.sub(r'[^\w_.-]', '_', pdf_filename_base)
+        # Named after the per-upload temp file, so concurrent conversions never share images
+        pdf_filename_base = _SAFE_NAME_RE.sub('_', os.path.splitext(os.path.basename(pdf_file_path))[0])
         
-        logger.info(f"Processing PDF: {pdf_file_path}")
-        logger.info(f"Base filename for images: {pdf_filename_base}")
+        logger.info("Processing PDF: %s", pdf_file_path)
+        logger.info("Base filename for images: %s", pdf_filename_base)
         
         full_document_content_parts = []
 
         try:
-            try:
-                pdfinfo_from_path(pdf_file_path, poppler_path=None)
-            except Exception as pe:
-                print(f"Poppler/pdf2image check failed: {pe}. Ensure Poppler is installed and in PATH.")
-                if "Unable to get page count" in str(pe) or "No output received from Poppler" in str(pe):
-                    return f"Error: Poppler (PDF rendering utility) not found or not working correctly. Please ensure it's installed and in your system's PATH. Original error: {pe}"
-
             pdf = pdfium.PdfDocument(pdf_file_path)
             n_pages = len(pdf)
 
-            for i in range(n_pages):
-                page_content_parts = []
-                page_text_content = ""
-                perform_ocr_on_this_page = False
-
-                # 1. Try direct text extraction
-                page = pdf.get_page(i)
-                textpage = page.get_textpage()
-                try:
-                    extracted_text_direct = textpage.get_text_bounded()
-                except AttributeError:
-                    try:
-                        extracted_text_direct = textpage.get_text_range()
-                    except AttributeError:
-                        extracted_text_direct = str(textpage)
-                
-                page_text_content = extracted_text_direct.strip()
-
-                # 2. Decide if OCR is needed for this page
-                if force_ocr_all_pages:
-                    perform_ocr_on_this_page = True
-                    print(f"Forcing OCR on page {i+1} as per force_ocr_all_pages flag.")
-                elif force_ocr_pages and i in force_ocr_pages:
-                    perform_ocr_on_this_page = True
-                    print(f"Forcing OCR on page {i+1} as per force_ocr_pages list.")
-                elif len(page_text_content) < self.MIN_TEXT_LENGTH_FOR_NO_OCR:
-                    try:
-                        text_objects = textpage.get_text_objects()
-                        if len(text_objects) > 0:
-                            print(f"Page {i+1} has minimal direct text (length: {len(page_text_content)}). Attempting OCR.")
-                            perform_ocr_on_this_page = True
-                        else:
-                            print(f"Page {i+1} has minimal direct text but also appears to have no objects. Skipping OCR.")
-                    except AttributeError:
-                        if not page_text_content:
-                            print(f"Page {i+1} has no text content. Attempting OCR.")
-                            perform_ocr_on_this_page = True
-                        else:
-                            print(f"Page {i+1} has minimal text content. Skipping OCR.")
-
-                # 3. Perform OCR if decided
-                if perform_ocr_on_this_page:
-                    try:
-                        print(f"Attempting OCR on page {i+1}...")
-                        images = convert_from_path(pdf_file_path, first_page=i+1, last_page=i+1, dpi=300)
-                        if images:
-                            pil_image = images[0].convert('L')
-                            ocr_text = pytesseract.image_to_string(pil_image, lang='eng').strip()
-                            if ocr_text:
-                                print(f"OCR successful for page {i+1}. Length: {len(ocr_text)}")
-                                if len(page_text_content) < self.MIN_TEXT_LENGTH_FOR_NO_OCR:
-                                    page_text_content = ocr_text
-                                else:
-                                    page_text_content += "\n\n--- OCR Text ---\n" + ocr_text
-                            else:
-                                print(f"OCR for page {i+1} yielded no text.")
-                        else:
-                            page_text_content += f"\n[OCR attempted but no image returned for page {i+1}]"
-                    except Exception as e:
-                        ocr_error_msg = f"\n[OCR error on page {i+1}: {str(e)}]"
-                        page_text_content += ocr_error_msg
-                        print(ocr_error_msg)
-
-                if page_text_content:
-                    page_content_parts.append(page_text_content)
-
-                # 4. Extract images using PyMuPDF
-                image_links = self._extract_images_with_pymupdf(pdf_file_path, i, pdf_filename_base)
-                page_content_parts.extend(image_links)
+            page_results = {}
+            fitz_doc = fitz.open(pdf_file_path)
+            ocr_engines = _TesseractEngines(lang=self.OCR_LANG)
+            try:
+                with ThreadPoolExecutor(max_workers=max(1, min(n_pages, self._max_page_workers))) as executor:
+                    futures = [
+                        executor.submit(self._process_page, pdf, fitz_doc, ocr_engines, i, pdf_filename_base,
+                                        force_ocr_all_pages, force_ocr_pages)
+                        for i in range(n_pages)
+                    ]
+                    for future in as_completed(futures):
+                        i, page_content_parts = future.result()
+                        page_results[i] = page_content_parts
+            finally:
+                ocr_engines.close()
+                fitz_doc.close()
+                with _PDFIUM_LOCK:
+                    pdf.close()
 
+            for i in range(n_pages):
+                page_content_parts = page_results[i]
                 if page_content_parts:
                     full_document_content_parts.append(f"\n--- Page {i+1} ---\n" + "\n".join(filter(None, page_content_parts)))
                 else:
@@ -234,6 +342,6 @@ class PDFProcessingTool(BaseTool):
 
         except Exception as e:
             import traceback
-            logger.error(f"Error processing PDF: {str(e)}")
+            logger.error("Error processing PDF: %s", e)
             logger.error(traceback.format_exc())
             return f"Error processing PDF: {str(e)}"
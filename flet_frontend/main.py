@@ -1,11 +1,112 @@
 import flet as ft
-import httpx # For making HTTP requests to the backend
+import aiohttp # For streaming PDF uploads to the backend
+import httpx # For fetching result images from the backend
+import asyncio
+import base64 # For embedding prefetched images
+import hashlib # For keying cached conversion results on PDF content
 import os
-import tempfile # For handling file downloads if needed
-import json # For parsing JSON responses
+import shutil
+import tempfile # Converted markdown is kept in a temp file until saved
+import time # For the elapsed-time display and result cache ages
+from collections import OrderedDict
+import orjson # Faster JSON parsing for large conversion responses
+from dataclasses import dataclass, field
+from typing import Optional
+from urllib.parse import quote, urljoin, urlsplit # quote: for sending the PDF name in a header
 
 # Global variable to store the backend URL (can be configured)
 BACKEND_API_URL = "http://localhost:8000/api/v1/convert" # Your FastAPI backend endpoint
+# scheme://host:port of the backend, which the relative image URLs it returns are resolved against
+BACKEND_ORIGIN = urlsplit(BACKEND_API_URL)._replace(path="", query="", fragment="").geturl()
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # PDFs are streamed to the backend in 1 MiB chunks
+IMAGE_CACHE_MAX_ENTRIES = 64 # Fetched result images kept per session
+RESULT_CACHE_MAX_ENTRIES = 16 # Conversion results kept per session
+# The backend deletes a result's images after its IMAGE_TTL_SECONDS (default 3600), so cached
+# results are only reused for a while less than that; keep the two in step.
+RESULT_CACHE_TTL_SECONDS = 3000
+
+async def stream_file(path):
+    """Yields a file's contents chunk by chunk, doing all file I/O in a worker thread so the UI never blocks."""
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        while chunk := await asyncio.to_thread(f.read, UPLOAD_CHUNK_SIZE):
+            yield chunk
+    finally:
+        await asyncio.to_thread(f.close)
+
+def file_sha256(path):
+    """Blocking SHA-256 of a file's contents; run it via asyncio.to_thread."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def looks_like_pdf(path):
+    """Blocking check that a file is non-empty and starts with the PDF magic bytes; run it via asyncio.to_thread."""
+    try:
+        if os.path.getsize(path) == 0:
+            return False
+        with open(path, 'rb') as f:
+            return f.read(5) == b'%PDF-'
+    except (OSError, TypeError): # TypeError: no local path (e.g. web mode)
+        return False
+
+def write_temp_markdown(content):
+    """Blocking write of markdown to a new temp file, returning its path; run it via asyncio.to_thread."""
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".md", delete=False) as f:
+        f.write(content)
+    return f.name
+
+def read_text_file(path):
+    """Blocking read of a UTF-8 text file; run it via asyncio.to_thread."""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def copy_file(src, dst):
+    """Blocking copy of src to dst (creating its directory); run it via asyncio.to_thread."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.copyfile(src, dst) # Uses the OS fast-copy path (sendfile on Linux)
+
+def remove_file(path):
+    """Blocking delete that ignores files already gone; run it via asyncio.to_thread."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class LRUCache(OrderedDict):
+    """Dict holding at most max_entries items; the least recently used ones are evicted first."""
+    def __init__(self, max_entries):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        """Stores value under key and returns the values evicted to make room for it."""
+        self[key] = value
+        self.move_to_end(key)
+        evicted = []
+        while len(self) > self.max_entries:
+            evicted.append(self.popitem(last=False)[1])
+        return evicted
+
+# --- Session State ---
+@dataclass(slots=True)
+class State:
+    """Per-session UI state, shared by the event handlers in main()."""
+    api_key: str = ""
+    pdf_path: Optional[str] = None
+    pdf_name: Optional[str] = None
+    md_path: Optional[str] = None # Markdown temp file of the result on screen, for download
+    md_filename: str = ""
+    result_cache: LRUCache = field(default_factory=lambda: LRUCache(RESULT_CACHE_MAX_ENTRIES)) # PDF SHA-256 -> {"md_path", "image_urls", "created"}
+    image_cache: LRUCache = field(default_factory=lambda: LRUCache(IMAGE_CACHE_MAX_ENTRIES)) # image URL -> bytes
 
 # --- Flet Application Main Function ---
 def main(page: ft.Page):
@@ -16,13 +117,36 @@ def main(page: ft.Page):
     page.padding = 20
     page.scroll = ft.ScrollMode.ADAPTIVE # Allow scrolling if content overflows
 
-    # --- State Management (using page.session for simplicity, or create a class) ---
-    if not page.session.get("gemini_api_key"):
-        page.session.set("gemini_api_key", "")
-    if not page.session.get("selected_pdf_path"):
-        page.session.set("selected_pdf_path", None)
-    if not page.session.get("selected_pdf_name"):
-        page.session.set("selected_pdf_name", None)
+    # --- State Management ---
+    state = State()
+
+    # --- HTTP Clients ---
+    # One client per session, reused across conversions so connections are kept alive.
+    # Uploads go through aiohttp, whose streaming upload path is faster than httpx's for
+    # large files; httpx handles the small image GETs.
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(300.0, connect=10.0), # Long read timeout for potentially long processing
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
+    upload_session = None # aiohttp needs a running event loop, so it is created on first use
+
+    async def get_upload_session():
+        nonlocal upload_session
+        if upload_session is None or upload_session.closed:
+            upload_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=300, connect=10), # Increased timeout for potentially long processing
+                connector=aiohttp.TCPConnector(limit=100),
+            )
+        return upload_session
+
+    async def on_page_close(e):
+        await http_client.aclose()
+        if upload_session is not None:
+            await upload_session.close()
+        # Every converted result's markdown lives in a temp file owned by the result cache
+        await asyncio.gather(*(asyncio.to_thread(remove_file, entry["md_path"]) for entry in state.result_cache.values()))
+
+    page.on_close = on_page_close
 
     # --- UI Controls ---
 
@@ -31,30 +155,40 @@ def main(page: ft.Page):
         label="Gemini API Key",
         password=True,
         can_reveal_password=True,
-        value=page.session.get("gemini_api_key"),
+        value=state.api_key,
         width=400,
-        on_change=lambda e: page.session.set("gemini_api_key", e.control.value)
+        # No on_change: the key is read once when Convert is clicked, not on every keystroke
     )
 
     # File Picker
-    def on_file_picked(e: ft.FilePickerResultEvent):
+    async def on_file_picked(e: ft.FilePickerResultEvent):
         if e.files and len(e.files) > 0:
             picked_file = e.files[0]
-            page.session.set("selected_pdf_path", picked_file.path)
-            page.session.set("selected_pdf_name", picked_file.name)
+            # Reject empty or non-PDF files here rather than after a full upload and conversion
+            if not await asyncio.to_thread(looks_like_pdf, picked_file.path):
+                state.pdf_path = None
+                state.pdf_name = None
+                file_name_display.value = "No PDF selected."
+                status_text.value = f"Error: '{picked_file.name}' is empty or not a valid PDF."
+                status_text.color = ft.colors.RED_ACCENT_700
+                page.update(file_name_display, status_text)
+                return
+            state.pdf_path = picked_file.path
+            state.pdf_name = picked_file.name
             file_name_display.value = f"Selected: {picked_file.name}"
             status_text.value = f"PDF '{picked_file.name}' selected. Ready to convert."
+            status_text.color = ft.colors.BLUE_GREY_400
             # Clear previous results
-            markdown_output_text.value = ""
+            set_markdown_output("")
             image_gallery.controls.clear()
             download_button.disabled = True
-            page.update()
+            page.update(file_name_display, status_text, markdown_container, image_gallery, download_button)
         else:
-            page.session.set("selected_pdf_path", None)
-            page.session.set("selected_pdf_name", None)
+            state.pdf_path = None
+            state.pdf_name = None
             file_name_display.value = "No PDF selected."
             status_text.value = "File selection cancelled or no file picked."
-            page.update()
+            page.update(file_name_display, status_text)
 
     file_picker = ft.FilePicker(on_result=on_file_picked)
     page.overlay.append(file_picker) # Required for FilePicker to work
@@ -74,14 +208,33 @@ def main(page: ft.Page):
     processing_indicator = ft.ProgressRing(width=24, height=24, stroke_width=3, visible=False)
 
     # Markdown Output Display
-    markdown_output_text = ft.Markdown(
-        "", # Initial content
-        selectable=True,
-        extension_set=ft.MarkdownExtensionSet.GITHUB_WEB, # For good Markdown rendering
-        code_theme="atom-one-dark",
-        auto_follow_links=True,
-        width=700, # Adjust as needed
+    # The Markdown control (extension parser + code theme) is only built once there is a
+    # result to show, so it stays off the startup path
+    markdown_output_text = None
+    markdown_container = ft.Container(
+        border=ft.border.all(1, ft.colors.OUTLINE),
+        border_radius=ft.border_radius.all(5),
+        padding=10,
+        margin=ft.margin.symmetric(vertical=10),
+        bgcolor=ft.colors.SURFACE_VARIANT, # Light background for markdown
     )
+
+    def set_markdown_output(text):
+        """Shows text in the results area, creating the Markdown control on first use."""
+        nonlocal markdown_output_text
+        if markdown_output_text is None:
+            if not text:
+                return # Nothing to clear yet
+            markdown_output_text = ft.Markdown(
+                "", # Initial content
+                selectable=True,
+                extension_set=ft.MarkdownExtensionSet.GITHUB_WEB, # For good Markdown rendering
+                code_theme="atom-one-dark",
+                auto_follow_links=True,
+                width=700, # Adjust as needed
+            )
+            markdown_container.content = markdown_output_text
+        markdown_output_text.value = text
     
     # Image Gallery
     image_gallery = ft.Row(
@@ -101,97 +254,179 @@ def main(page: ft.Page):
     )
 
     # --- Event Handlers ---
+    async def fetch_images(image_urls):
+        """
+        Downloads images concurrently over the shared client and returns a URL -> bytes dict
+        of the ones available. URLs in the session's image cache are not downloaded again.
+        """
+        images = {}
+        missing_urls = []
+        for url in dict.fromkeys(image_urls):
+            image_bytes = state.image_cache.get(url)
+            if image_bytes is None:
+                missing_urls.append(url)
+            else:
+                images[url] = image_bytes
+        responses = await asyncio.gather(*(http_client.get(url) for url in missing_urls), return_exceptions=True)
+        for url, response in zip(missing_urls, responses):
+            if isinstance(response, httpx.Response) and response.is_success:
+                images[url] = response.content
+                state.image_cache.put(url, response.content)
+            else:
+                error = response if isinstance(response, Exception) else f"HTTP {response.status_code}"
+                print(f"Error fetching image {url}: {error}")
+        return images
+
+    async def show_elapsed(message):
+        """Appends a seconds counter to the status line once a second until cancelled."""
+        started = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            status_text.value = f"{message} ({int(time.monotonic() - started)}s)"
+            page.update(status_text)
+
     async def convert_pdf_clicked(e):
-        api_key = page.session.get("gemini_api_key")
-        pdf_path = page.session.get("selected_pdf_path")
-        pdf_name = page.session.get("selected_pdf_name")
+        api_key = state.api_key = api_key_field.value
+        pdf_path = state.pdf_path
+        pdf_name = state.pdf_name
 
         if not api_key:
             status_text.value = "Error: Gemini API Key is missing."
             status_text.color = ft.colors.RED_ACCENT_700
-            page.update()
+            page.update(status_text)
             return
         if not pdf_path:
             status_text.value = "Error: No PDF file selected."
             status_text.color = ft.colors.RED_ACCENT_700
-            page.update()
+            page.update(status_text)
             return
 
         status_text.value = f"Processing '{pdf_name}'..."
         status_text.color = ft.colors.BLUE_700
         processing_indicator.visible = True
         convert_button.disabled = True
-        markdown_output_text.value = "" # Clear previous output
+        set_markdown_output("") # Clear previous output
         image_gallery.controls.clear()
         image_gallery.visible = False
         download_button.disabled = True
-        page.update()
+        state.md_path = None
+        # Targeted update: status changes shouldn't re-render the whole page
+        page.update(status_text, processing_indicator, convert_button, markdown_container, image_gallery, download_button)
 
         try:
-            # Prepare file for upload
-            files = {'pdf_file': (pdf_name, open(pdf_path, 'rb'), 'application/pdf')}
-            headers = {'gemini-api-key': api_key}
-
-            async with httpx.AsyncClient(timeout=300.0) as client: # Increased timeout for potentially long processing
-                response = await client.post(BACKEND_API_URL, files=files, headers=headers)
-            
-            response.raise_for_status() # Will raise an exception for 4XX/5XX errors
-            result_data = response.json()
-
-            if result_data.get("error"):
-                status_text.value = f"Backend Error: {result_data['error']}"
+            # Results are cached per PDF content, so re-converting the same file skips the backend.
+            # An entry points at its markdown temp file, so the only in-memory copy of the
+            # markdown is the one on screen.
+            cache_key = await asyncio.to_thread(file_sha256, pdf_path)
+            cached_result = state.result_cache.get(cache_key)
+            if cached_result is not None and time.monotonic() - cached_result["created"] > RESULT_CACHE_TTL_SECONDS:
+                # Its images are gone from the backend by now, so convert again
+                state.result_cache.pop(cache_key, None)
+                await asyncio.to_thread(remove_file, cached_result["md_path"])
+                cached_result = None
+            raw_md = None
+            backend_error = None
+            if cached_result is not None:
+                try:
+                    raw_md = await asyncio.to_thread(read_text_file, cached_result["md_path"])
+                except OSError: # Temp file removed behind our back; convert again
+                    state.result_cache.pop(cache_key, None)
+                    cached_result = None
+            from_cache = cached_result is not None
+
+            if not from_cache:
+                # The backend expects the raw PDF bytes as the request body, streamed from disk
+                headers = {
+                    'gemini-api-key': api_key,
+                    'pdf-filename': quote(pdf_name),
+                    'content-type': 'application/pdf',
+                    'content-length': str(await asyncio.to_thread(os.path.getsize, pdf_path)),
+                }
+
+                # The backend only has markdown once the whole document is converted, so show
+                # progress on the status line while waiting
+                elapsed_ticker = asyncio.create_task(show_elapsed(status_text.value))
+                try:
+                    session = await get_upload_session()
+                    async with session.post(BACKEND_API_URL, data=stream_file(pdf_path), headers=headers) as response:
+                        response_body = await response.read()
+                        if not response.ok: # Raise for 4XX/5XX errors, keeping the backend's error detail
+                            raise aiohttp.ClientResponseError(
+                                response.request_info, response.history,
+                                status=response.status, message=response_body.decode("utf-8", errors="replace")
+                            )
+                finally:
+                    elapsed_ticker.cancel()
+                result_data = orjson.loads(response_body)
+                backend_error = result_data.get("error")
+                if not backend_error:
+                    raw_md = result_data.get("raw_markdown_content", "# No content received")
+                    cached_result = {
+                        "md_path": await asyncio.to_thread(write_temp_markdown, raw_md),
+                        "image_urls": result_data.get("image_urls") or [],
+                        "created": time.monotonic(),
+                    }
+                    for evicted in state.result_cache.put(cache_key, cached_result):
+                        await asyncio.to_thread(remove_file, evicted["md_path"])
+
+            if cached_result is None:
+                status_text.value = f"Backend Error: {backend_error}"
                 status_text.color = ft.colors.RED_ACCENT_700
-                markdown_output_text.value = f"## Error\n\n{result_data['error']}"
+                set_markdown_output(f"## Error\n\n{backend_error}")
             else:
-                raw_md = result_data.get("raw_markdown_content", "# No content received")
-                markdown_output_text.value = raw_md
-                status_text.value = "Conversion successful!"
+                set_markdown_output(raw_md)
+                status_text.value = "Conversion successful! (cached result)" if from_cache else "Conversion successful!"
                 status_text.color = ft.colors.GREEN_700
                 
-                # Store content for download
-                page.session.set("markdown_to_download", raw_md)
-                page.session.set("markdown_filename", f"{os.path.splitext(pdf_name)[0]}.md")
+                # Download copies the cache entry's temp file
+                state.md_path = cached_result["md_path"]
+                state.md_filename = f"{os.path.splitext(pdf_name)[0]}.md"
                 download_button.disabled = False
 
                 # Display images
-                image_urls = result_data.get("image_urls", [])
+                image_urls = cached_result["image_urls"]
                 if image_urls:
-                    image_gallery.controls.clear()
-                    for img_url in image_urls:
-                        # Assuming image_urls are relative to the backend's static serving
-                        # e.g., /static/images/image.png
-                        # The backend_url needs to be prepended if not already absolute
-                        full_img_url = f"http://localhost:8000{img_url}" if img_url.startswith("/static") else img_url
-                        image_gallery.controls.append(
-                            ft.Image(
-                                src=full_img_url,
-                                width=150,
-                                height=150,
-                                fit=ft.ImageFit.CONTAIN,
-                                error_content=ft.Text(f"Error loading: {os.path.basename(img_url)}", size=10)
-                            )
+                    # image_urls are relative to the backend's static serving (e.g. /static/images/image.png);
+                    # urljoin resolves them against the backend origin and leaves absolute URLs as they are
+                    full_img_urls = [urljoin(BACKEND_ORIGIN, u) for u in image_urls]
+                    # Fetch all images up front so the gallery renders from memory
+                    images = await fetch_images(full_img_urls)
+                    # One assignment, so Flet sees a single mutation of the gallery
+                    image_gallery.controls = [
+                        ft.Image(
+                            **(
+                                {"src_base64": base64.b64encode(images[u]).decode("ascii")}
+                                if u in images else {"src": u}
+                            ),
+                            width=150,
+                            height=150,
+                            fit=ft.ImageFit.CONTAIN,
+                            error_content=ft.Text(f"Error loading: {os.path.basename(u)}", size=10)
                         )
+                        for u in full_img_urls
+                    ]
                     image_gallery.visible = True
                 else:
                     image_gallery.visible = False
 
 
-        except httpx.HTTPStatusError as http_err:
-            error_detail = f"HTTP error occurred: {http_err.response.status_code} - {http_err.response.text}"
+        except aiohttp.ClientResponseError as http_err:
+            error_detail = f"HTTP error occurred: {http_err.status} - {http_err.message}"
             status_text.value = error_detail
             status_text.color = ft.colors.RED_ACCENT_700
-            markdown_output_text.value = f"## HTTP Error\n\n{error_detail}"
-            print(f"HTTP error: {http_err} - Response: {http_err.response.text}")
+            set_markdown_output(f"## HTTP Error\n\n{error_detail}")
+            print(f"HTTP error: {http_err.status} - Response: {http_err.message}")
         except Exception as ex:
             error_detail = f"An unexpected error occurred: {str(ex)}"
             status_text.value = error_detail
             status_text.color = ft.colors.RED_ACCENT_700
-            markdown_output_text.value = f"## Application Error\n\n{error_detail}"
+            set_markdown_output(f"## Application Error\n\n{error_detail}")
             print(f"Unexpected error: {ex}")
         finally:
             processing_indicator.visible = False
             convert_button.disabled = False
-            page.update()
+            # One targeted update per conversion, once the result (or error) is in place
+            page.update(status_text, processing_indicator, convert_button, markdown_container, image_gallery, download_button)
 
     convert_button = ft.ElevatedButton(
         "Convert to Markdown",
@@ -203,30 +438,15 @@ def main(page: ft.Page):
     )
 
     def on_download_click(e):
-        # Get the filename from session storage with proper error handling
-        try:
-            md_filename = page.session.get("markdown_filename")
-            if not md_filename:
-                md_filename = "converted.md"
-            elif not md_filename.endswith(".md"):
-                md_filename += ".md"
-        except Exception as ex:
-            print(f"Error getting filename from session: {ex}")
-            md_filename = "converted.md"
+        md_filename = state.md_filename or "converted.md"
+        if not md_filename.endswith(".md"):
+            md_filename += ".md"
         
         # Ensure we have content to save
-        try:
-            content = page.session.get("markdown_to_download")
-            if not content:
-                status_text.value = "No content to save. Please convert a PDF first."
-                status_text.color = ft.colors.AMBER_700
-                page.update()
-                return
-        except Exception as ex:
-            print(f"Error getting content from session: {ex}")
-            status_text.value = "Error accessing saved content. Please try converting again."
-            status_text.color = ft.colors.RED_ACCENT_700
-            page.update()
+        if not state.md_path:
+            status_text.value = "No content to save. Please convert a PDF first."
+            status_text.color = ft.colors.AMBER_700
+            page.update(status_text)
             return
             
         try:
@@ -240,25 +460,14 @@ def main(page: ft.Page):
             status_text.value = error_msg
             status_text.color = ft.colors.RED_ACCENT_700
             print(f"Save dialog error: {error_msg}")
-            page.update()
+            page.update(status_text)
 
-    def save_markdown_file(e: ft.FilePickerResultEvent):
+    async def save_markdown_file(e: ft.FilePickerResultEvent):
         if e.path:
             try:
-                # Get content from session with proper error handling
-                try:
-                    content_to_save = page.session.get("markdown_to_download")
-                except Exception as ex:
-                    print(f"Error getting content from session: {ex}")
-                    content_to_save = None
-
-                if content_to_save:
-                    # Ensure the directory exists
-                    os.makedirs(os.path.dirname(e.path), exist_ok=True)
-                    
-                    # Write the content with proper encoding
-                    with open(e.path, "w", encoding="utf-8") as f:
-                        f.write(content_to_save)
+                if state.md_path:
+                    # Copy off the UI thread; slow or network drives would otherwise freeze the app
+                    await asyncio.to_thread(copy_file, state.md_path, e.path)
                     
                     # Show success message
                     status_text.value = f"Markdown saved successfully to: {e.path}"
@@ -271,7 +480,7 @@ def main(page: ft.Page):
                 status_text.value = error_msg
                 status_text.color = ft.colors.RED_ACCENT_700
                 print(f"Save error: {error_msg}")
-            page.update()
+            page.update(status_text)
 
     save_file_dialog = ft.FilePicker(on_result=save_markdown_file)
     page.overlay.append(save_file_dialog)
@@ -301,14 +510,7 @@ def main(page: ft.Page):
                 ft.Divider(height=30),
 
                 ft.Text("4. Results", size=18, weight=ft.FontWeight.W_600),
-                ft.Container(
-                    content=markdown_output_text,
-                    border=ft.border.all(1, ft.colors.OUTLINE),
-                    border_radius=ft.border_radius.all(5),
-                    padding=10,
-                    margin=ft.margin.symmetric(vertical=10),
-                    bgcolor=ft.colors.SURFACE_VARIANT, # Light background for markdown
-                ),
+                markdown_container,
                 image_gallery, # Row for images
                 download_button,
             ],
@@ -319,7 +521,6 @@ def main(page: ft.Page):
             expand=True # Allow column to expand
         )
     )
-    page.update()
 
 # --- Run the Flet app ---
 # To run as a web app: flet run main.py -w